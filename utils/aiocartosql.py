@@ -0,0 +1,175 @@
+'''
+asyncio counterpart of cartoUploads using aiohttp
+Requests share one connection pool and at most CONCURRENCY of them are in
+flight at once, so independent calls (e.g. writes to different tables)
+can overlap with fetching and parsing in the same event loop.
+Example:
+```
+import asyncio
+import aiocartosql
+
+async def main():
+    await asyncio.gather(
+        aiocartosql.insertRows('table_a', fields, dtypes, rows_a),
+        aiocartosql.insertRows('table_b', fields, dtypes, rows_b))
+    await aiocartosql.closeSession()
+
+asyncio.get_event_loop().run_until_complete(main())
+```
+'''
+import os
+import json
+import asyncio
+import logging
+
+import aiohttp
+
+import cartoUploads
+from cartoUploads import CARTO_URL, CARTO_USER, CARTO_KEY, CartoError
+
+# Maximum number of concurrent requests to CARTO
+CONCURRENCY = int(os.environ.get('CARTO_CONCURRENCY', 10))
+
+_session = None
+_semaphore = None
+
+
+class Response(object):
+    '''Minimal requests-like response: `status_code`, `ok`, `text`, json()'''
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _getSession():
+    '''Return the shared session, creating it in the running loop'''
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+        _session = aiohttp.ClientSession(connector=connector)
+        _semaphore = asyncio.Semaphore(CONCURRENCY)
+    return _session
+
+
+async def closeSession():
+    '''Close pooled connections; call before the event loop stops'''
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
+    '''Send arbitrary sql and return response object or False'''
+    url = CARTO_URL.format(user)
+    payload = {
+        'api_key': key,
+        'q': sql,
+    }
+    if len(f):
+        payload['format'] = f
+    session = _getSession()
+    async with _semaphore:
+        if post:
+            request = session.post(url, json=payload)
+        else:
+            request = session.get(url, params=payload)
+        async with request as resp:
+            r = Response(resp.status, await resp.text())
+    if not r.ok:
+        logging.error(r.text)
+        if cartoUploads.STRICT:
+            raise CartoError(r.text, r.status_code)
+        return False
+    return r
+
+
+async def get(sql, user=CARTO_USER, key=CARTO_KEY, f=''):
+    '''Send arbitrary sql and return response object or False'''
+    return await sendSql(sql, user, key, f, False)
+
+
+async def post(sql, user=CARTO_USER, key=CARTO_KEY, f=''):
+    '''Send arbitrary sql and return response object or False'''
+    return await sendSql(sql, user, key, f)
+
+
+async def getFields(fields, table, where='', order='', user=CARTO_USER,
+                    key=CARTO_KEY, f='', post=False):
+    '''Select fields from table'''
+    fields = (fields,) if isinstance(fields, str) else fields
+    where = ' WHERE {}'.format(where) if where else ''
+    order = ' ORDER BY {}'.format(order) if order else ''
+    sql = 'SELECT {} FROM "{}" {} {}'.format(
+        ','.join(fields), table, where, order)
+    return await sendSql(sql, user, key, f, post)
+
+
+async def _insertValues(table, fields, values, user=CARTO_USER,
+                        key=CARTO_KEY):
+    sql = 'INSERT INTO "{}" ({}) VALUES {}'.format(
+        table, ', '.join(fields), values)
+    return bool(await post(sql, user, key))
+
+
+async def insertRows(table, fields, dtypes, rows, user=CARTO_USER,
+                     key=CARTO_KEY, blocksize=1000):
+    '''
+    Insert rows into table
+    `rows` must be a list of lists containing the data to be inserted
+    `fields` field names for the columns in `rows`
+    `dtypes` field types for the columns in `rows`
+    Geometries are rounded to the table's setting in GEOM_PRECISION.
+    Breaks into requests of `blocksize` rows which are sent concurrently,
+    at most CONCURRENCY at a time across all calls. After the first
+    failure no new blocks are sent and the row ranges that landed are
+    logged (and set as `landed` on the raised error).
+    '''
+    fields = list(fields)
+    dtypes = tuple(dtypes)
+    blocks = cartoUploads._iterBlocks(
+        rows, dtypes, blocksize,
+        precision=cartoUploads.GEOM_PRECISION.get(table))
+    pending = {}
+    landed, failed = [], []
+    error = None
+    while True:
+        while not failed and len(pending) < CONCURRENCY:
+            block = next(blocks, None)
+            if block is None:
+                break
+            start, end, values = block
+            task = asyncio.ensure_future(
+                _insertValues(table, fields, values, user, key))
+            pending[task] = (start, end)
+        if not pending:
+            break
+        done, _ = await asyncio.wait(pending,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            block = pending.pop(task)
+            try:
+                ok = task.result()
+            except Exception as e:
+                error = error or e
+                ok = False
+            (landed if ok else failed).append(block)
+    if failed:
+        landed = cartoUploads._mergeRanges(landed)
+        logging.error('Insert into {} failed for rows {}; landed rows {}'.format(
+            table, cartoUploads._mergeRanges(failed), landed))
+        if error is not None:
+            error.landed = landed
+            raise error
+        return False
+    return True
+
+
+async def deleteRows(table, where, user=CARTO_USER, key=CARTO_KEY):
+    '''Delete rows from table'''
+    sql = 'DELETE FROM "{}" WHERE {}'.format(table, where)
+    return await post(sql, user, key)
@@ -0,0 +1,79 @@
+'''
+Micro-benchmark of cartoUploads row serialization
+Compares the per-cell _escapeValue implementation against the compiled
+per-schema serializer on an OpenAQ-like page of rows (cit_003 schema).
+Usage:
+```
+python utils/benchmarks/dumpRows.py [nrows] [repeat]
+```
+'''
+import os
+import sys
+import random
+import timeit
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cartoUploads
+
+CARTO_SCHEMA = OrderedDict([
+    ("the_geom", "geometry"),
+    ("_UID", "text"),
+    ("utc", "timestamp"),
+    ("value", "numeric"),
+    ("parameter", "text"),
+    ("location", "text"),
+    ("city", "text"),
+    ("country", "text"),
+    ("unit", "text"),
+    ("attribution", "text"),
+    ("ppm", "numeric")
+])
+
+
+def legacyDumpRows(rows, dtypes):
+    '''Serializer as it was before schemas were compiled'''
+    dumpedRows = []
+    for row in rows:
+        escaped = [
+            cartoUploads._escapeValue(row[i], dtypes[i])
+            for i in range(len(dtypes))
+        ]
+        dumpedRows.append('({})'.format(','.join(escaped)))
+    return ','.join(dumpedRows)
+
+
+def makeRows(n):
+    rows = []
+    for i in range(n):
+        rows.append([
+            {'type': 'Point', 'coordinates': [random.uniform(-180, 180),
+                                              random.uniform(-90, 90)]},
+            '{:032x}'.format(random.getrandbits(128)),
+            '2020-01-01T{:02d}:00:00.000Z'.format(i % 24),
+            random.uniform(0, 500),
+            'pm25',
+            "St. Mary's Station {}".format(i % 100),
+            'City {}'.format(i % 50),
+            'US',
+            'µg/m³',
+            None if i % 3 else '[{"name": "EPA AirNow"}]',
+            random.uniform(0, 1),
+        ])
+    return rows
+
+
+def main(nrows=10000, repeat=5):
+    rows = makeRows(nrows)
+    dtypes = tuple(CARTO_SCHEMA.values())
+    for name, fn in (('legacy', legacyDumpRows),
+                     ('compiled', cartoUploads._dumpRows)):
+        best = min(timeit.repeat(lambda: fn(rows, dtypes),
+                                 number=1, repeat=repeat))
+        size = len(fn(rows, dtypes))
+        print('{:<10} {:8.1f} ms  {:10d} chars  ({} rows)'.format(
+            name, best * 1000, size, nrows))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
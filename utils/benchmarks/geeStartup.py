@@ -0,0 +1,53 @@
+'''
+Benchmark of EE/GCS setup cost in geeUploadsUtils
+Times the per-construction setup assetManagement used to do (write both
+key files, ee.Initialize, new storage client, bucket lookup) against the
+process-wide session from geeUploadsUtils.initialize/getBucket, cold and
+warm. Needs the same environment as the scripts: GEE_SACCOUNT, GEE_JSON,
+GCS_JSON, plus the bucket to look up.
+Usage:
+```
+python utils/benchmarks/geeStartup.py <gcsBucket> [repeat]
+```
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ee
+from google.cloud import storage
+import geeUploadsUtils
+
+
+def perConstructionSetup(bucket):
+    '''Setup as previously repeated for every assetManagement'''
+    with open('gcsPrivatekey.json', 'w') as f:
+        f.write(os.getenv('GCS_JSON'))
+    with open('geePrivatekey.json', 'w') as f:
+        f.write(os.getenv('GEE_JSON'))
+    credentials = ee.ServiceAccountCredentials(os.getenv('GEE_SACCOUNT'),
+                                               'geePrivatekey.json')
+    ee.Initialize(credentials)
+    client = storage.Client.from_service_account_json('gcsPrivatekey.json')
+    return client.get_bucket(bucket)
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def main(bucket, repeat=5):
+    old = [timed(perConstructionSetup, bucket) for i in range(repeat)]
+    new = [timed(geeUploadsUtils.getBucket, bucket) for i in range(repeat)]
+    print('per-construction setup: {:.3f} s each, {:.3f} s for {} calls'.format(
+        sum(old) / repeat, sum(old), repeat))
+    print('shared session:         {:.3f} s cold, {:.6f} s warm, '
+          '{:.3f} s for {} calls'.format(new[0], max(new[1:] or [0]),
+                                         sum(new), repeat))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], *[int(a) for a in sys.argv[2:3]])
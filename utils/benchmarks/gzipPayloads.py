@@ -0,0 +1,130 @@
+'''
+Benchmark of gzip-compressed SQL API request bodies
+Builds INSERT payloads for a batch of point rows (dis_001 earthquakes) and
+a batch of polygon rows (foo_003 FEWS food insecurity), and reports the
+raw and gzipped payload size and the time spent compressing.
+If CARTO_USER and CARTO_KEY are set, also times sending each payload
+with and without compression. Live requests insert into a temporary
+table inside a transaction that is rolled back, so nothing is written.
+Usage:
+```
+python utils/benchmarks/gzipPayloads.py [nrows] [repeat]
+```
+'''
+import os
+import sys
+import json
+import gzip
+import math
+import random
+import timeit
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cartoUploads
+
+POINT_SCHEMA = OrderedDict([
+    ('uid', 'text'),
+    ('the_geom', 'geometry'),
+    ('depth_in_km', 'numeric'),
+    ('datetime', 'timestamp'),
+    ('mag', 'numeric'),
+    ('place', 'text'),
+    ('sig', 'numeric'),
+    ('magType', 'text'),
+])
+POLYGON_SCHEMA = OrderedDict([
+    ('the_geom', 'geometry'),
+    ('_uid', 'text'),
+    ('start_date', 'timestamp'),
+    ('end_date', 'timestamp'),
+    ('ifc_type', 'text'),
+    ('ifc', 'numeric')
+])
+
+
+def pointRows(n):
+    rows = []
+    for i in range(n):
+        lon, lat = random.uniform(-180, 180), random.uniform(-90, 90)
+        dt = '2020-01-{:02d}T{:02d}:00:00Z'.format(i % 28 + 1, i % 24)
+        rows.append([
+            '{}_{}_{}_{}'.format(lat, lon, 10.0, dt),
+            {'type': 'Point', 'coordinates': [lon, lat]},
+            random.uniform(0, 100), dt, random.uniform(2, 8),
+            '{} km NNE of Somewhere, Country'.format(i % 200),
+            random.randint(0, 1000), 'mb',
+        ])
+    return rows
+
+
+def polygon(cx, cy, radius, nvertices):
+    ring = [[cx + radius * math.cos(2 * math.pi * k / nvertices) *
+             random.uniform(0.8, 1.2),
+             cy + radius * math.sin(2 * math.pi * k / nvertices) *
+             random.uniform(0.8, 1.2)]
+            for k in range(nvertices)]
+    ring.append(ring[0])
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+
+def polygonRows(n, nvertices=200):
+    rows = []
+    for i in range(n):
+        rows.append([
+            polygon(random.uniform(-20, 50), random.uniform(-30, 30),
+                    random.uniform(0.1, 2), nvertices),
+            '{:032x}'.format(random.getrandbits(128)),
+            '2020-02-01', '2020-05-31', 'CS', random.randint(1, 5),
+        ])
+    return rows
+
+
+def payload(schema, rows):
+    values = cartoUploads._dumpRows(rows, tuple(schema.values()))
+    sql = 'INSERT INTO "bench" ({}) VALUES {}'.format(
+        ', '.join(schema.keys()), values)
+    return sql, json.dumps({'q': sql}).encode('utf-8')
+
+
+def live(schema, sql, repeat):
+    '''Time posting `sql` uncompressed and gzipped; returns seconds'''
+    defs = ','.join('{} {}'.format(k, v) for k, v in schema.items())
+    sql = 'BEGIN; CREATE TEMP TABLE "bench" ({}); {}; ROLLBACK'.format(
+        defs, sql)
+    saved = cartoUploads.GZIP_MIN_BYTES
+    times = []
+    try:
+        for setting in (None, 0):
+            cartoUploads.GZIP_MIN_BYTES = setting
+            times.append(min(timeit.repeat(
+                lambda: cartoUploads.post(sql, cartoUploads.CARTO_USER,
+                                          cartoUploads.CARTO_KEY),
+                number=1, repeat=repeat)))
+    finally:
+        cartoUploads.GZIP_MIN_BYTES = saved
+    return times
+
+
+def main(nrows=1000, repeat=3):
+    doLive = cartoUploads.CARTO_USER and cartoUploads.CARTO_KEY
+    for name, schema, rows in (
+            ('points', POINT_SCHEMA, pointRows(nrows)),
+            ('polygons', POLYGON_SCHEMA, polygonRows(nrows // 10 or 1))):
+        sql, body = payload(schema, rows)
+        compressed = gzip.compress(body, cartoUploads.GZIP_LEVEL)
+        elapsed = min(timeit.repeat(
+            lambda: gzip.compress(body, cartoUploads.GZIP_LEVEL),
+            number=1, repeat=repeat))
+        print('{:<9} {:5d} rows  {:10d} -> {:9d} bytes ({:4.1f}x) '
+              'in {:6.1f} ms'.format(
+                  name, len(rows), len(body), len(compressed),
+                  len(body) / len(compressed), elapsed * 1000))
+        if doLive:
+            plain, gzipped = live(schema, sql, repeat)
+            print('{:<9} end-to-end: {:6.3f} s plain, {:6.3f} s gzip'.format(
+                name, plain, gzipped))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
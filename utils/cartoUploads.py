@@ -14,17 +14,228 @@ http://carto.com/docs/carto-engine/sql-api/making-calls/
 from __future__ import unicode_literals
 from builtins import str
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import logging
 import json
+import datetime
+import csv
+import codecs
+import struct
+import binascii
+import gzip
+import zlib
+import time
+import re
+import threading
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 CARTO_URL = 'https://{}.carto.com/api/v2/sql'
+COPY_URL = CARTO_URL + '/copyfrom'
+JOB_URL = CARTO_URL + '/job'
+JOB_FINISHED_STATES = ('done', 'failed', 'canceled', 'unknown')
 CARTO_USER = os.environ.get('CARTO_USER')
 CARTO_KEY = os.environ.get('CARTO_KEY')
 STRICT = True
 
-def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
-    '''Send arbitrary sql and return response object or False'''
+# insertRows streams rows through COPY at or above this many rows
+COPY_THRESHOLD = 5000
+# Number of rows encoded per chunk of a streamed COPY body
+COPY_CHUNKSIZE = 1000
+
+# Byte-budgeted batching (insertRows `maxbytes`): requests faster than half
+# TARGET_LATENCY seconds grow the budget, slower ones shrink it
+TARGET_LATENCY = 5.0
+MIN_BATCH_BYTES = 64 * 1024
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Decimal places that geometry coordinates are rounded to, per table; see
+# setPrecision. Tables not listed are sent at full precision.
+GEOM_PRECISION = {}
+
+# Gzip request bodies of at least this many bytes; None disables. The
+# endpoint (or a proxy in front of it) must accept Content-Encoding: gzip
+GZIP_MIN_BYTES = (int(os.environ['CARTO_GZIP_MIN_BYTES'])
+                  if os.environ.get('CARTO_GZIP_MIN_BYTES') else None)
+GZIP_LEVEL = 6
+
+# Seconds that cached table listings and existence checks stay valid
+CATALOG_TTL = 300
+
+# Number of keep-alive connections kept open per Carto host
+POOL_SIZE = int(os.environ.get('CARTO_POOL_SIZE', 10))
+
+_session = None
+_sessionLock = threading.Lock()
+
+
+def getSession():
+    '''
+    Return the module-level requests session, creating it on first use
+    Connections to `{user}.carto.com` are pooled and kept alive so that
+    consecutive calls (e.g. blocks of `insertRows`) reuse the same TCP+TLS
+    connection instead of paying a new handshake per request.
+    '''
+    global _session
+    session = _session
+    if session is None:
+        with _sessionLock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                                      pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+                _session = session
+            session = _session
+    return session
+
+
+def setPoolSize(size):
+    '''
+    Set the connection pool size, replacing the current session
+    Call before making requests; requests in flight on other threads
+    keep using the old session.
+    '''
+    global POOL_SIZE
+    POOL_SIZE = int(size)
+    closeSession()
+
+
+def closeSession():
+    '''Close pooled connections; a new session is created on next call'''
+    global _session
+    with _sessionLock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+# Instrumentation sinks, called with a record of every SQL API request
+_sinks = []
+
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|COPY)\s+"?([\w.]+)"?',
+                        re.IGNORECASE)
+_TOTAL_ROWS = re.compile(r'"total_rows"\s*:\s*(\d+)')
+
+
+def addSink(sink):
+    '''
+    Register callable `sink(record)` to be called after each request
+    `record` is a dict with keys: verb, table, request_bytes,
+    response_bytes, rows, status, latency (seconds).
+    See logSink, JsonLinesSink and CounterSink.
+    '''
+    _sinks.append(sink)
+
+
+def removeSink(sink):
+    '''Unregister a sink added with addSink'''
+    _sinks.remove(sink)
+
+
+def _describeSql(sql):
+    '''Return (verb, table) of an SQL statement'''
+    head = sql[:1000]
+    words = head.split(None, 1)
+    verb = words[0].upper() if words else ''
+    m = _SQL_TABLE.search(head)
+    return verb, m.group(1) if m else None
+
+
+def _responseRows(r, f, stream):
+    '''Row count of a response, if it can be read cheaply'''
+    if stream:
+        return None
+    if f == 'csv':
+        return max(r.text.count('\n') - 1, 0)
+    if not f:
+        m = _TOTAL_ROWS.search(r.text[-200:])
+        return int(m.group(1)) if m else None
+    return None
+
+
+def _emit(sql, request_bytes, r, latency, f='', stream=False):
+    '''Send a request record to all sinks'''
+    verb, table = _describeSql(sql)
+    record = {
+        'verb': verb,
+        'table': table,
+        'request_bytes': request_bytes,
+        'response_bytes': None if stream else len(r.content),
+        'rows': _responseRows(r, f, stream) if r.ok else None,
+        'status': r.status_code,
+        'latency': latency,
+    }
+    for sink in list(_sinks):
+        try:
+            sink(record)
+        except Exception as e:
+            logging.warning('Instrumentation sink failed: {}'.format(e))
+
+
+def logSink(record):
+    '''Sink that logs each request at DEBUG level'''
+    logging.debug('{verb} {table}: {status} in {latency:.3f}s, '
+                  '{request_bytes} bytes sent, {response_bytes} bytes '
+                  'received, {rows} rows'.format(**record))
+
+
+class JsonLinesSink(object):
+    '''Sink that appends each request record to a JSON-lines file'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class CounterSink(object):
+    '''Sink that totals requests, bytes, rows and time per (verb, table)'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def __call__(self, record):
+        k = (record['verb'], record['table'])
+        with self.lock:
+            t = self.totals.setdefault(k, {
+                'requests': 0, 'errors': 0, 'request_bytes': 0,
+                'response_bytes': 0, 'rows': 0, 'latency': 0.0})
+            t['requests'] += 1
+            t['errors'] += record['status'] >= 400
+            t['request_bytes'] += record['request_bytes']
+            t['response_bytes'] += record['response_bytes'] or 0
+            t['rows'] += record['rows'] or 0
+            t['latency'] += record['latency']
+
+    def summary(self):
+        '''Return totals as a list of dicts, slowest first'''
+        with self.lock:
+            rows = [dict(t, verb=k[0], table=k[1])
+                    for k, t in self.totals.items()]
+        return sorted(rows, key=lambda t: -t['latency'])
+
+    def log(self):
+        '''Log the summary at INFO level'''
+        for t in self.summary():
+            logging.info('{verb} {table}: {requests} requests ({errors} '
+                         'failed) in {latency:.1f}s, {request_bytes} bytes '
+                         'sent, {response_bytes} bytes received, {rows} '
+                         'rows'.format(**t))
+
+
+def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True,
+            stream=False):
+    '''
+    Send arbitrary sql and return response object or False
+    `stream` defers downloading the response body (see requests)
+    '''
     url = CARTO_URL.format(user)
     payload = {
         'api_key': key,
@@ -32,15 +243,53 @@ def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
     }
     if len(f):
         payload['format'] = f
-    logging.debug((url, payload))
+    logging.debug('{} {}'.format(url, sql[:200]))
+    session = getSession()
+    t = time.time()
+    sent = None
     if post:
-        r = requests.post(url, json=payload)
+        body = json.dumps(payload).encode('utf-8')
+        sent = len(body)
+        if GZIP_MIN_BYTES is not None and sent >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, GZIP_LEVEL)
+            sent = len(body)
+            headers = {'Content-Type': 'application/json',
+                       'Content-Encoding': 'gzip'}
+            r = session.post(url, data=body, headers=headers, stream=stream)
+        else:
+            r = session.post(url, json=payload, stream=stream)
     else:
-        r = requests.get(url, params=payload)
+        r = session.get(url, params=payload, stream=stream)
+    if _sinks:
+        if sent is None:
+            sent = len(sql.encode('utf-8'))
+        _emit(sql, sent, r, time.time() - t, f, stream)
+    return _checkResponse(r)
+
+
+def _gzipChunks(chunks):
+    '''Gzip-compress a stream of byte chunks'''
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CartoError(Exception):
+    '''Error response from the SQL API; `status` is the HTTP status code'''
+    def __init__(self, message, status=None):
+        super(CartoError, self).__init__(message)
+        self.status = status
+
+
+def _checkResponse(r):
+    '''Return response if ok, else log and raise or return False'''
     if not r.ok:
         logging.error(r.text)
         if STRICT:
-            raise Exception(r.text)
+            raise CartoError(r.text, r.status_code)
         return False
     return r
 
@@ -66,17 +315,173 @@ def getFields(fields, table, where='', order='', user=CARTO_USER,
     return sendSql(sql, user, key, f, post)
 
 
+def _parseTimestamp(value):
+    '''Parse a timestamp as formatted in CARTO CSV or JSON output'''
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+                '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized timestamp: {}'.format(value))
+
+
+def _parseBool(value):
+    return value.lower() in ('true', 't')
+
+
+_PARSERS = {
+    'numeric': float,
+    'float': float,
+    'double precision': float,
+    'int': int,
+    'integer': int,
+    'bigint': int,
+    'boolean': _parseBool,
+    'timestamp': _parseTimestamp,
+}
+
+
+def _iterLines(r, chunk_size=64 * 1024):
+    '''Yield decoded lines, with line endings, from a streamed response'''
+    buf = ''
+    for chunk in codecs.iterdecode(r.iter_content(chunk_size), 'utf-8'):
+        buf += chunk
+        lines = buf.split('\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if buf:
+        yield buf
+
+
+def iterFields(fields, table, where='', dtypes=None, id_field='cartodb_id',
+               pagesize=10000, user=CARTO_USER, key=CARTO_KEY):
+    '''
+    Iterate over field values in table, paging by `id_field`
+    Each page is selected WHERE `id_field` > last ORDER BY `id_field`
+    LIMIT `pagesize` and its CSV rows are decoded as they arrive, so memory
+    use does not grow with table size.
+    Yields single values if `fields` is a string, otherwise tuples.
+    `dtypes` field types used to parse values (numeric, int, boolean,
+    timestamp, ...); other types, and text, are yielded as strings.
+    Empty values of parsed types are yielded as None.
+    A page that fails raises CartoError even if not STRICT, so a partial
+    listing is never mistaken for the whole table.
+    '''
+    single = isinstance(fields, str)
+    fields = [fields] if single else list(fields)
+    dtypes = [''] * len(fields) if dtypes is None else (
+        [dtypes] if isinstance(dtypes, str) else list(dtypes))
+    parsers = [_PARSERS.get(d) for d in dtypes]
+    select = fields if id_field in fields else fields + [id_field]
+    idx = select.index(id_field)
+    last = None
+    while True:
+        conditions = ['({})'.format(where)] if where else []
+        if last is not None:
+            conditions.append('{} > {}'.format(
+                id_field, _escapeValue(last, 'text')))
+        sql = 'SELECT {} FROM "{}" {} ORDER BY {} LIMIT {}'.format(
+            ','.join(select), table,
+            'WHERE {}'.format(' AND '.join(conditions)) if conditions else '',
+            id_field, int(pagesize))
+        r = sendSql(sql, user, key, 'csv', True, stream=True)
+        if not r:
+            raise CartoError('Failed to read {} after {} {}'.format(
+                table, id_field, last))
+        n = 0
+        try:
+            reader = csv.reader(_iterLines(r))
+            next(reader, None)
+            for row in reader:
+                n += 1
+                last = row[idx]
+                values = tuple(
+                    row[i] if parsers[i] is None else (
+                        parsers[i](row[i]) if row[i] != '' else None)
+                    for i in range(len(fields)))
+                yield values[0] if single else values
+        finally:
+            r.close()
+        if n < pagesize:
+            return
+
+
+def getMostRecentDate(table, time_field, where='', user=CARTO_USER,
+                      key=CARTO_KEY):
+    '''
+    Return the latest value of `time_field` in table as a datetime
+    Asks the server for MAX(`time_field`), optionally filtered by `where`,
+    which is answered from the time index rather than downloading the
+    column. Returns None if no rows match.
+    '''
+    where = ' WHERE {}'.format(where) if where else ''
+    sql = 'SELECT MAX({}) FROM "{}"{}'.format(time_field, table, where)
+    r = get(sql, user, key, f='csv')
+    if not r:
+        return None
+    value = r.text.split('\r\n')[1]
+    return _parseTimestamp(value) if value else None
+
+
+# Per-process table catalog: user -> (time, list of tables) and
+# (user, table) -> (time, exists)
+_catalog = {}
+_tableExists = {}
+
+
+def invalidateCatalog(user=None):
+    '''Drop cached table listings for `user`, or for all users'''
+    if user is None:
+        _catalog.clear()
+        _tableExists.clear()
+    else:
+        _catalog.pop(user, None)
+        for k in [k for k in _tableExists if k[0] == user]:
+            _tableExists.pop(k, None)
+
+
+def _fresh(cached):
+    return cached is not None and time.time() - cached[0] < CATALOG_TTL
+
+
 def getTables(user=CARTO_USER, key=CARTO_KEY, f='csv'):
-    '''Get the list of tables'''
+    '''
+    Get the list of tables
+    The csv listing is cached for CATALOG_TTL seconds; createTable and
+    dropTable invalidate it.
+    '''
+    if f == 'csv':
+        cached = _catalog.get(user)
+        if _fresh(cached):
+            return list(cached[1])
     r = get('SELECT * FROM CDB_UserTables()',user, key, f=f)
     if f == 'csv':
-        return r.text.split("\r\n")[1:-1]
+        tables = r.text.split("\r\n")[1:-1]
+        _catalog[user] = (time.time(), tables)
+        return list(tables)
     return r
 
 
 def tableExists(table, user=CARTO_USER, key=CARTO_KEY):
-    '''Check if table exists'''
-    return table in getTables()
+    '''
+    Check if table exists
+    Answered from the cached catalog when fresh, otherwise with a
+    to_regclass lookup of just this table, itself cached for CATALOG_TTL
+    '''
+    cached = _catalog.get(user)
+    if _fresh(cached):
+        return table in cached[1]
+    cached = _tableExists.get((user, table))
+    if _fresh(cached):
+        return cached[1]
+    name = _escapeValue('"{}"'.format(table), 'text')
+    r = get('SELECT to_regclass({}) IS NOT NULL AS found'.format(name),
+            user, key)
+    exists = r.json()['rows'][0]['found']
+    _tableExists[(user, table)] = (time.time(), exists)
+    return exists
 
 
 def createTable(table, schema, user=CARTO_USER, key=CARTO_KEY):
@@ -89,7 +494,9 @@ def createTable(table, schema, user=CARTO_USER, key=CARTO_KEY):
     items = schema.items() if isinstance(schema, dict) else schema
     defslist = ['{} {}'.format(k, v) for k, v in items]
     sql = 'CREATE TABLE "{}" ({})'.format(table, ','.join(defslist))
-    if post(sql, user, key):
+    r = post(sql, user, key)
+    invalidateCatalog(user)
+    if r:
         return _cdbfyTable(table, user, key)
     return False
 
@@ -100,17 +507,110 @@ def _cdbfyTable(table, user=CARTO_USER, key=CARTO_KEY):
     return post(sql, user, key)
 
 
-def createIndex(table, fields, unique='', using='', user=CARTO_USER,
-                key=CARTO_KEY):
-    '''Create index on table on field(s)'''
+def _indexSql(table, fields, unique='', using=''):
+    '''SQL creating index idx_{table}_{fields} on field(s)'''
     fields = (fields,) if isinstance(fields, str) else fields
     f_underscore = '_'.join(fields)
     f_comma = ','.join(fields)
     unique = 'UNIQUE' if unique else ''
     using = 'USING {}'.format(using) if using else ''
-    sql = 'CREATE {} INDEX idx_{}_{} ON {} {} ({})'.format(
+    return 'CREATE {} INDEX idx_{}_{} ON {} {} ({})'.format(
         unique, table, f_underscore, table, using, f_comma)
-    return post(sql, user, key)
+
+
+def _provisionIndexes(table, unique=None, indexes=(), spatial=True,
+                      time_field=None, time_index='btree'):
+    '''Return the index SQL statements for provisionTable arguments'''
+    statements = []
+    if unique:
+        statements.append(_indexSql(table, unique, unique=True))
+    for fields in indexes:
+        statements.append(_indexSql(table, fields))
+    if time_field:
+        statements.append(_indexSql(table, time_field, using=time_index))
+    if spatial:
+        statements.append('CREATE INDEX IF NOT EXISTS {0}_the_geom_idx ON '
+                          '"{0}" USING GIST (the_geom)'.format(table))
+    return statements
+
+
+def createIndex(table, fields, unique='', using='', user=CARTO_USER,
+                key=CARTO_KEY):
+    '''Create index on table on field(s)'''
+    return post(_indexSql(table, fields, unique, using), user, key)
+
+
+def provisionTable(table, schema, unique=None, indexes=(), spatial=True,
+                   time_field=None, time_index='btree', user=CARTO_USER,
+                   key=CARTO_KEY):
+    '''
+    Create, CartoDBfy and index table in one transaction and request
+    `schema` as for createTable
+    `unique` field(s) to create a unique index on, e.g. the UID field
+    `indexes` list of further field(s) to index
+    `spatial` create a GIST index on the_geom if not already present
+    `time_field` field to index using `time_index`: 'btree' serves
+    MAX(time_field) and ORDER BY time_field (getMostRecentDate,
+    deleteExcessRows); 'brin' is far smaller but only suits range filters
+    on append-only tables
+    If any statement fails the table is not created.
+    '''
+    items = schema.items() if isinstance(schema, dict) else schema
+    defslist = ['{} {}'.format(k, v) for k, v in items]
+    statements = [
+        'BEGIN',
+        'CREATE TABLE "{}" ({})'.format(table, ','.join(defslist)),
+        "SELECT cdb_cartodbfytable('{}','\"{}\"')".format(user, table),
+    ]
+    statements.extend(_provisionIndexes(table, unique, indexes, spatial,
+                                        time_field, time_index))
+    statements.append('COMMIT')
+    r = post('; '.join(statements), user, key)
+    invalidateCatalog(user)
+    return r
+
+
+def refreshTable(table, schema, rows, unique=None, indexes=(), spatial=True,
+                 time_field=None, time_index='btree', user=CARTO_USER,
+                 key=CARTO_KEY, **kwargs):
+    '''
+    Replace all rows of table without it ever being empty or partial
+    `rows` are bulk loaded into an unlogged staging table
+    ({table}_staging), then copied over in one transaction that deletes
+    the old rows and inserts the new ones; readers see the old rows until
+    it commits. The live table itself is kept, with its grants, privacy
+    setting and the maps that use it. The staging table is then dropped.
+    If table does not exist it is first created by provisionTable, with
+    the index arguments as for provisionTable.
+    `rows` must be in `schema` order; further keyword arguments are passed
+    to insertRows.
+    '''
+    staging = '{}_staging'.format(table)
+    items = list(schema.items() if isinstance(schema, dict) else schema)
+    fields = [k for k, v in items]
+    dtypes = [v for k, v in items]
+    defslist = ['{} {}'.format(k, v) for k, v in items]
+    if not tableExists(table, user, key):
+        if not provisionTable(table, items, unique, indexes, spatial,
+                              time_field, time_index, user, key):
+            return False
+    post('DROP TABLE IF EXISTS "{0}"; CREATE UNLOGGED TABLE "{0}" ({1})'.format(
+        staging, ','.join(defslist)), user, key)
+    try:
+        kwargs.setdefault('precision', GEOM_PRECISION.get(table))
+        if not insertRows(staging, fields, dtypes, rows, user, key, **kwargs):
+            return False
+        f_comma = ', '.join(fields)
+        statements = [
+            'BEGIN',
+            'DELETE FROM "{}"'.format(table),
+            'INSERT INTO "{0}" ({1}) SELECT {1} FROM "{2}"'.format(
+                table, f_comma, staging),
+            'COMMIT',
+        ]
+        return post('; '.join(statements), user, key)
+    finally:
+        post('DROP TABLE IF EXISTS "{}"'.format(staging), user, key)
 
 
 def _escapeValue(value, dtype):
@@ -141,49 +641,788 @@ def _escapeValue(value, dtype):
         return str(value)
 
 
-def _dumpRows(rows, dtypes):
+def _escapeText(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _escapeGeometry(value, precision=None):
+    # strings are passed as is; GeoJSON is sent as hex EWKB with SRID, or
+    # in a compact quantized form when a precision is given
+    if isinstance(value, str):
+        return value
+    if (precision is not None and
+            _TWKB_MIN_PRECISION <= precision <= _TWKB_MAX_PRECISION):
+        return _quantizedGeometry(value, precision)
+    return "'" + _geojsonToEWKB(value, precision=precision) + "'::geometry"
+
+
+_ESCAPES = {
+    'geometry': _escapeGeometry,
+    'text': _escapeText,
+    'timestamp': _escapeText,
+    'varchar': _escapeText,
+}
+
+
+@lru_cache(maxsize=None)
+def _compileRowSerializer(dtypes, precision=None):
+    '''
+    Return a function escaping a row to an SQL string for `dtypes`
+    Escape functions are looked up once per schema rather than per cell;
+    equivalent to _escapeValue except that GeoJSON geometries are sent as
+    hex EWKB literals, with coordinates rounded to `precision` if given.
+    '''
+    escapes = [_ESCAPES.get(dtype, str) for dtype in dtypes]
+    if precision is not None:
+        escapes = [partial(_escapeGeometry, precision=precision)
+                   if escape is _escapeGeometry else escape
+                   for escape in escapes]
+    escapes = tuple(escapes)
+
+    def dumpRow(row):
+        return '(' + ','.join([
+            'NULL' if value is None else escape(value)
+            for escape, value in zip(escapes, row)
+        ]) + ')'
+    return dumpRow
+
+
+def _dumpRows(rows, dtypes, precision=None):
     '''Escapes rows of data to SQL strings'''
-    dumpedRows = []
-    for row in rows:
-        escaped = [
-            _escapeValue(row[i], dtypes[i])
-            for i in range(len(dtypes))
+    dumpRow = _compileRowSerializer(tuple(dtypes), precision)
+    return ','.join([dumpRow(row) for row in rows])
+
+
+_WKB_TYPES = {
+    'Point': 1,
+    'LineString': 2,
+    'Polygon': 3,
+    'MultiPoint': 4,
+    'MultiLineString': 5,
+    'MultiPolygon': 6,
+    'GeometryCollection': 7,
+}
+_EWKB_Z = 0x80000000
+_EWKB_SRID = 0x20000000
+
+
+def _coordDims(coords):
+    '''Number of dimensions (2 or 3) of nested GeoJSON coordinates'''
+    while isinstance(coords, (list, tuple)) and len(coords):
+        if not isinstance(coords[0], (list, tuple)):
+            return 3 if len(coords) > 2 else 2
+        coords = coords[0]
+    return 2
+
+
+def _quantizePoints(points, dims, precision, minPoints):
+    '''
+    Round coordinates to `precision` decimals and drop repeated points,
+    unless that would leave fewer than `minPoints`
+    '''
+    rounded = [[round(c, precision) for c in pt[:dims]] for pt in points]
+    deduped = [pt for i, pt in enumerate(rounded)
+               if not i or pt != rounded[i - 1]]
+    return deduped if len(deduped) >= minPoints else rounded
+
+
+def _packPoints(points, dims, precision=None, minPoints=2):
+    if precision is not None:
+        points = _quantizePoints(points, dims, precision, minPoints)
+    flat = [c for pt in points for c in pt[:dims]]
+    return struct.pack('<I{}d'.format(len(flat)), len(points), *flat)
+
+
+def _writeWKB(geom, parts, srid=None, precision=None):
+    '''
+    Append little-endian (E)WKB for GeoJSON `geom` to list `parts`
+    If `precision` is given coordinates are rounded to that many decimals
+    '''
+    gtype = geom['type']
+    if gtype == 'GeometryCollection':
+        children = geom['geometries']
+        dims = _coordDims(children[0]['coordinates']) if children else 2
+    else:
+        coords = geom['coordinates']
+        dims = _coordDims(coords)
+    code = _WKB_TYPES[gtype]
+    if dims == 3:
+        code |= _EWKB_Z
+    if srid:
+        parts.append(struct.pack('<BII', 1, code | _EWKB_SRID, srid))
+    else:
+        parts.append(struct.pack('<BI', 1, code))
+
+    if gtype == 'Point':
+        # empty points are encoded as NaN coordinates
+        pt = coords[:dims] if len(coords) else [float('nan')] * dims
+        if precision is not None:
+            pt = [round(c, precision) for c in pt]
+        parts.append(struct.pack('<{}d'.format(dims), *pt))
+    elif gtype == 'LineString':
+        parts.append(_packPoints(coords, dims, precision, 2))
+    elif gtype == 'Polygon':
+        parts.append(struct.pack('<I', len(coords)))
+        for ring in coords:
+            parts.append(_packPoints(ring, dims, precision, 4))
+    elif gtype == 'GeometryCollection':
+        parts.append(struct.pack('<I', len(children)))
+        for child in children:
+            _writeWKB(child, parts, None, precision)
+    else:
+        # Multi*: members are WKB geometries of the singular type
+        parts.append(struct.pack('<I', len(coords)))
+        subtype = gtype[5:]
+        for member in coords:
+            _writeWKB({'type': subtype, 'coordinates': member}, parts,
+                      None, precision)
+
+
+_EWKB_POINT = struct.Struct('<BIIdd')
+
+
+def _geojsonToEWKB(geom, srid=4326, precision=None):
+    '''
+    Encode GeoJSON geometry dict as hex EWKB with SRID
+    If `precision` is given coordinates are rounded to that many decimals
+    '''
+    if geom['type'] == 'Point' and len(geom['coordinates']) == 2:
+        # fast path for the most common case
+        x, y = geom['coordinates']
+        if precision is not None:
+            x, y = round(x, precision), round(y, precision)
+        return binascii.hexlify(_EWKB_POINT.pack(
+            1, _WKB_TYPES['Point'] | _EWKB_SRID, srid, x, y)).decode('ascii')
+    parts = []
+    _writeWKB(geom, parts, srid, precision)
+    return binascii.hexlify(b''.join(parts)).decode('ascii')
+
+
+_TWKB_MIN_PRECISION = -8
+_TWKB_MAX_PRECISION = 7
+
+
+def _varint(n, out):
+    '''Append unsigned LEB128 varint `n` to bytearray `out`'''
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (~n << 1) | 1
+
+
+def _twkbPoints(points, scales, prev, out, minPoints=1, count=True):
+    '''
+    Append points as zigzag varint deltas from `prev`, which is updated
+    Repeated points left by quantization are dropped unless that would
+    leave fewer than `minPoints`.
+    '''
+    dims = len(scales)
+    ints = [[int(round(pt[d] * scales[d])) for d in range(dims)]
+            for pt in points]
+    deduped = [pt for i, pt in enumerate(ints) if not i or pt != ints[i - 1]]
+    if len(deduped) >= minPoints:
+        ints = deduped
+    if count:
+        _varint(len(ints), out)
+    for pt in ints:
+        for d in range(dims):
+            _varint(_zigzag(pt[d] - prev[d]), out)
+            prev[d] = pt[d]
+
+
+def _writeTWKB(geom, out, precision):
+    '''Append TWKB for GeoJSON `geom` at `precision` decimals to `out`'''
+    gtype = geom['type']
+    if gtype == 'GeometryCollection':
+        members = geom['geometries']
+        dims = _coordDims(members[0]['coordinates']) if members else 2
+    else:
+        members = geom['coordinates']
+        dims = _coordDims(members)
+    out.append(_WKB_TYPES[gtype] | _zigzag(precision) << 4)
+    # metadata: bit 3 extended dimensions, bit 4 empty geometry
+    out.append((0x08 if dims == 3 else 0) | (0 if members else 0x10))
+    zprecision = min(max(precision, 0), _TWKB_MAX_PRECISION)
+    if dims == 3:
+        out.append(0x01 | zprecision << 2)
+    if not members:
+        return
+    scales = [10 ** precision] * 2 + [10 ** zprecision] * (dims - 2)
+    prev = [0] * dims
+    if gtype == 'Point':
+        _twkbPoints([members], scales, prev, out, count=False)
+    elif gtype == 'LineString':
+        _twkbPoints(members, scales, prev, out, 2)
+    elif gtype == 'Polygon':
+        _varint(len(members), out)
+        for ring in members:
+            _twkbPoints(ring, scales, prev, out, 4)
+    elif gtype == 'MultiPoint':
+        _varint(len(members), out)
+        _twkbPoints(members, scales, prev, out, len(members), count=False)
+    elif gtype == 'MultiLineString':
+        _varint(len(members), out)
+        for line in members:
+            _twkbPoints(line, scales, prev, out, 2)
+    elif gtype == 'MultiPolygon':
+        _varint(len(members), out)
+        for polygon in members:
+            _varint(len(polygon), out)
+            for ring in polygon:
+                _twkbPoints(ring, scales, prev, out, 4)
+    else:
+        # collection members are complete TWKB geometries
+        _varint(len(members), out)
+        for member in members:
+            _writeTWKB(member, out, precision)
+
+
+def _quantizedGeometry(geom, precision, srid=4326):
+    '''
+    SQL for GeoJSON geometry dict with coordinates at `precision` decimals
+    Points are sent as EWKT; other geometries as TWKB, whose varint
+    coordinate deltas take a few bytes each rather than 8 in WKB.
+    '''
+    coords = geom['coordinates'] if geom['type'] == 'Point' else None
+    if coords:
+        return "'SRID={};POINT({})'::geometry".format(srid, ' '.join(
+            [repr(round(c, precision)) for c in coords[:3]]))
+    out = bytearray()
+    _writeTWKB(geom, out, precision)
+    return "ST_SetSRID(ST_GeomFromTWKB(decode('{}','hex')),{})".format(
+        binascii.hexlify(bytes(out)).decode('ascii'), srid)
+
+
+def _csvValue(value, dtype, precision=None):
+    '''
+    Escape value for CSV COPY based on field type
+    None is written as an unquoted empty field, which COPY reads as NULL;
+    everything else is quoted, with GeoJSON geometries sent as hex EWKB.
+    '''
+    if value is None:
+        return ''
+    if dtype == 'geometry' and not isinstance(value, str):
+        return _geojsonToEWKB(value, precision=precision)
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def _csvChunks(rows, dtypes, precision=None):
+    '''Yield CSV-encoded rows in chunks of COPY_CHUNKSIZE rows'''
+    for i in range(0, len(rows), COPY_CHUNKSIZE):
+        lines = [
+            ','.join([_csvValue(row[j], dtypes[j], precision)
+                      for j in range(len(dtypes))])
+            for row in rows[i:i + COPY_CHUNKSIZE]
         ]
-        dumpedRows.append('({})'.format(','.join(escaped)))
-    return ','.join(dumpedRows)
+        lines.append('')
+        yield '\n'.join(lines).encode('utf-8')
+
+
+def _copyable(rows, dtypes):
+    '''
+    True if rows can be sent with COPY
+    String geometries may be SQL expressions which COPY cannot evaluate.
+    '''
+    geomCols = [i for i, d in enumerate(dtypes) if d == 'geometry']
+    return not any(isinstance(row[i], str) for row in rows for i in geomCols)
+
+
+def copyRows(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY,
+             precision=None):
+    '''
+    Bulk load rows into table by streaming CSV to the COPY endpoint
+    `rows` must be a list of lists containing the data to be inserted
+    Geometries are sent as hex EWKB; string geometries are passed as is
+    and must therefore be WKT/EWKT or hex (E)WKB.
+    `precision` decimals to round coordinates to; defaults to the table's
+    setting in GEOM_PRECISION
+    '''
+    dtypes = tuple(dtypes)
+    if precision is None:
+        precision = GEOM_PRECISION.get(table)
+    sql = 'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table, ', '.join(fields))
+    params = {
+        'api_key': key,
+        'q': sql,
+    }
+    logging.debug((COPY_URL.format(user), sql, len(rows)))
+    sent = [0]
+    headers = {}
+    chunks = _csvChunks(rows, dtypes, precision)
+    if GZIP_MIN_BYTES is not None:
+        chunks = _gzipChunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    def body():
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+    t = time.time()
+    r = getSession().post(COPY_URL.format(user), params=params, data=body(),
+                          headers=headers)
+    if _sinks:
+        _emit(sql, sent[0], r, time.time() - t)
+    return _checkResponse(r)
 
 
-def _insertRows(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY):
-    values = _dumpRows(rows, tuple(dtypes))
-    sql = 'INSERT INTO "{}" ({}) VALUES {}'.format(
-        table, ', '.join(fields), values)
+def _insertValues(table, fields, values, user=CARTO_USER, key=CARTO_KEY,
+                  conflict=''):
+    '''Insert escaped `values`, followed by an ON CONFLICT clause if given'''
+    sql = 'INSERT INTO "{}" ({}) VALUES {} {}'.format(
+        table, ', '.join(fields), values, conflict)
     return post(sql, user, key)
 
 
+class _ByteBudget(object):
+    '''Target batch payload size, adapted from observed request latency'''
+    def __init__(self, size, latency=TARGET_LATENCY):
+        self.size = max(int(size), MIN_BATCH_BYTES)
+        self.latency = latency
+
+    def observe(self, elapsed):
+        if elapsed < self.latency / 2:
+            self.size = min(int(self.size * 1.5), MAX_BATCH_BYTES)
+        elif elapsed > self.latency:
+            self.size = max(int(self.size * self.latency / elapsed),
+                            MIN_BATCH_BYTES)
+
+    def shrink(self):
+        self.size = max(self.size // 2, MIN_BATCH_BYTES)
+
+
+def _isSizeError(e):
+    '''
+    True if a request was rejected because its payload was too large or slow
+    Only a 413 or a statement timeout guarantee nothing was inserted;
+    gateway errors may come after the statement committed, so resending
+    the block could duplicate rows.
+    '''
+    return isinstance(e, CartoError) and (
+        e.status == 413 or 'statement timeout' in str(e))
+
+
+def _iterBlocks(rows, dtypes, blocksize, budget=None, precision=None):
+    '''
+    Yield (start, end, values) blocks of rows escaped to SQL
+    Blocks are `blocksize` rows, or if `budget` is given, as many rows as
+    fit in `budget.size` characters of SQL (at least one row per block)
+    '''
+    if budget is None:
+        for start in range(0, len(rows), blocksize):
+            end = min(start + blocksize, len(rows))
+            yield start, end, _dumpRows(rows[start:end], dtypes, precision)
+        return
+    dumpRow = _compileRowSerializer(tuple(dtypes), precision)
+    start = 0
+    pending = None
+    while start < len(rows):
+        limit = budget.size
+        dumped, size, end = [], 0, start
+        while end < len(rows):
+            if pending is None:
+                pending = dumpRow(rows[end])
+            if dumped and size + len(pending) > limit:
+                break
+            dumped.append(pending)
+            size += len(pending) + 1
+            pending = None
+            end += 1
+        yield start, end, ','.join(dumped)
+        start = end
+
+
+def _insertBlock(table, fields, dtypes, rows, start, end, values, budget=None,
+                 user=CARTO_USER, key=CARTO_KEY, conflict='', precision=None):
+    '''
+    Insert block rows[start:end] escaped as `values`
+    Returns (landed, failed) lists of (start, end) row ranges.
+    With a `budget`, blocks rejected for size or timeout are halved and
+    retried, and request latency is fed back into the budget. Errors are
+    raised with the ranges of the block that landed set as `landed`.
+    '''
+    t = time.time()
+    try:
+        r = _insertValues(table, fields, values, user, key, conflict)
+    except Exception as e:
+        if budget is None or end - start < 2 or not _isSizeError(e):
+            e.landed = []
+            raise
+        budget.shrink()
+        mid = (start + end) // 2
+        logging.warning('Block of rows {}-{} too large, splitting'.format(
+            start, end))
+        landed = []
+        for lo, hi in ((start, mid), (mid, end)):
+            try:
+                ok, failed = _insertBlock(
+                    table, fields, dtypes, rows, lo, hi,
+                    _dumpRows(rows[lo:hi], dtypes, precision), budget,
+                    user, key, conflict, precision)
+            except Exception as err:
+                err.landed = landed + err.landed
+                raise
+            landed.extend(ok)
+            if failed:
+                return landed, failed + ([(mid, end)] if lo == start else [])
+        return landed, []
+    if budget is not None:
+        budget.observe(time.time() - t)
+    return ([(start, end)], []) if r else ([], [(start, end)])
+
+
+def _mergeRanges(ranges):
+    '''Merge adjacent (start, end) ranges into a sorted list'''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _missingRanges(start, end, landed):
+    '''Parts of the range (start, end) not covered by `landed` ranges'''
+    missing = []
+    for lo, hi in _mergeRanges(landed):
+        if lo > start:
+            missing.append((start, lo))
+        start = max(start, hi)
+    if start < end:
+        missing.append((start, end))
+    return missing
+
+
+def _insertFailed(table, landed, failed, error=None):
+    '''
+    Log the row ranges that did and did not land, then raise `error` with
+    the landed ranges set as its `landed` attribute, or return False
+    '''
+    landed = _mergeRanges(landed)
+    logging.error('Insert into {} failed for rows {}; landed rows {}'.format(
+        table, _mergeRanges(failed), landed))
+    if error is not None:
+        error.landed = landed
+        raise error
+    return False
+
+
+def _insertConcurrent(table, fields, dtypes, rows, blocks, budget, workers,
+                      user=CARTO_USER, key=CARTO_KEY, conflict='',
+                      precision=None):
+    '''
+    Insert blocks through a pool of `workers` threads
+    At most `workers` blocks are in flight. After the first failure no new
+    blocks are submitted, in-flight blocks finish, and the row ranges that
+    did and did not land are logged (and set as `landed` on the raised
+    error) before raising or returning False.
+    '''
+    blocks = iter(blocks)
+    pending = {}
+    landed, failed = [], []
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            while not failed and len(pending) < workers:
+                block = next(blocks, None)
+                if block is None:
+                    break
+                start, end, values = block
+                future = pool.submit(_insertBlock, table, fields, dtypes,
+                                     rows, start, end, values, budget,
+                                     user, key, conflict, precision)
+                pending[future] = (start, end)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end = pending.pop(future)
+                try:
+                    ok, bad = future.result()
+                except Exception as e:
+                    error = error or e
+                    ok = getattr(e, 'landed', [])
+                    bad = _missingRanges(start, end, ok)
+                landed.extend(ok)
+                failed.extend(bad)
+    if failed:
+        return _insertFailed(table, landed, failed, error)
+    return True
+
+
 def insertRows(table, fields, dtypes, rows, user=CARTO_USER,
-               key=CARTO_KEY, blocksize=1000):
+               key=CARTO_KEY, blocksize=1000, copy=None, maxbytes=None,
+               workers=1, precision=None):
     '''
     Insert rows into table
     `rows` must be a list of lists containing the data to be inserted
     `fields` field names for the columns in `rows`
     `dtypes` field types for the columns in `rows`
     Automatically breaks into multiple requests at `blocksize` rows
+    `copy` True to stream all rows in one COPY request (see copyRows),
+    False to always use INSERT; by default COPY is used from
+    COPY_THRESHOLD rows when no geometry is given as a string, no
+    `maxbytes` budget is set and `workers` is 1
+    `maxbytes` if given, size blocks by SQL payload instead of row count,
+    starting at `maxbytes` and adapting to server latency (TARGET_LATENCY)
+    `workers` if > 1, send up to `workers` blocks concurrently, at most
+    POOL_SIZE of them on kept-alive connections (see setPoolSize)
+    On failure no further blocks are sent and the row ranges that landed
+    are logged, and set as `landed` on the error if one is raised
+    `precision` decimals to round geometry coordinates to; defaults to the
+    table's setting in GEOM_PRECISION (see setPrecision)
     '''
+    fields = list(fields)
+    dtypes = tuple(dtypes)
+    if copy is None:
+        copy = (not maxbytes and workers <= 1 and
+                len(rows) >= COPY_THRESHOLD and _copyable(rows, dtypes))
+    if copy:
+        return bool(copyRows(table, fields, dtypes, rows, user, key,
+                             precision))
+    return _blockInsert(table, fields, dtypes, rows, user, key, blocksize,
+                        maxbytes, workers, precision=precision)
+
+
+def _blockInsert(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY,
+                 blocksize=1000, maxbytes=None, workers=1, conflict='',
+                 precision=None):
+    '''INSERT rows in blocks; see insertRows for arguments'''
+    if precision is None:
+        precision = GEOM_PRECISION.get(table)
+    budget = _ByteBudget(maxbytes) if maxbytes else None
+    blocks = _iterBlocks(rows, dtypes, blocksize, budget, precision)
+    if workers > 1:
+        if workers > POOL_SIZE:
+            logging.warning('{} insert workers share {} pooled connections; '
+                            'see setPoolSize'.format(workers, POOL_SIZE))
+        return _insertConcurrent(table, fields, dtypes, rows, blocks, budget,
+                                 workers, user, key, conflict, precision)
     # iterate in blocks
-    while len(rows):
-        if not _insertRows(table, fields, dtypes, rows[:blocksize], user, key):
-            return False
-        rows = rows[blocksize:]
+    landed = []
+    for start, end, values in blocks:
+        try:
+            ok, failed = _insertBlock(table, fields, dtypes, rows, start, end,
+                                      values, budget, user, key, conflict,
+                                      precision)
+        except Exception as e:
+            ok = getattr(e, 'landed', [])
+            return _insertFailed(table, landed + ok,
+                                 _missingRanges(start, end, ok), e)
+        landed.extend(ok)
+        if failed:
+            return _insertFailed(table, landed, failed)
     return True
 
 # Alias insertRows
 blockInsertRows = insertRows
 
 
-def deleteRows(table, where, user=CARTO_USER, key=CARTO_KEY):
-    '''Delete rows from table'''
+def upsertRows(table, fields, dtypes, rows, conflict_field, user=CARTO_USER,
+               key=CARTO_KEY, blocksize=1000, maxbytes=None, workers=1,
+               precision=None):
+    '''
+    Insert rows into table, replacing rows that share `conflict_field`
+    Uses INSERT ... ON CONFLICT (`conflict_field`) DO UPDATE, which requires
+    a unique index on `conflict_field` (e.g. createIndex(..., unique=True)).
+    If `rows` repeats a key, the last row for that key wins.
+    Other arguments as for insertRows.
+    '''
+    fields = list(fields)
+    dtypes = tuple(dtypes)
+    i = fields.index(conflict_field)
+    # a single statement may not update the same row twice
+    latest = {}
+    for row in rows:
+        latest[row[i]] = row
+    if len(latest) < len(rows):
+        rows = list(latest.values())
+    updates = ', '.join(['{0} = EXCLUDED.{0}'.format(f)
+                         for f in fields if f != conflict_field])
+    if updates:
+        conflict = 'ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            conflict_field, updates)
+    else:
+        conflict = 'ON CONFLICT ({}) DO NOTHING'.format(conflict_field)
+    return _blockInsert(table, fields, dtypes, rows, user, key, blocksize,
+                        maxbytes, workers, conflict, precision)
+
+
+def setPrecision(table, precision):
+    '''
+    Round geometry coordinates inserted into table to `precision` decimals
+    Repeated vertices left by rounding are dropped where the geometry stays
+    valid. 5 decimals is ~1 m at the equator; None restores full precision.
+    INSERTs send such geometries as TWKB (points as EWKT), which is much
+    smaller than full precision WKB for precisions from -8 to 7. COPY
+    still sends WKB, with rounded coordinates that only compress better.
+    '''
+    if precision is None:
+        GEOM_PRECISION.pop(table, None)
+    else:
+        GEOM_PRECISION[table] = int(precision)
+
+
+def deleteRows(table, where, user=CARTO_USER, key=CARTO_KEY, batch=False):
+    '''
+    Delete rows from table
+    `batch` run as a Batch SQL API job and return its id (see submitJob)
+    '''
     sql = 'DELETE FROM "{}" WHERE {}'.format(table, where)
-    return post(sql)
+    if batch:
+        return submitJob(sql, user, key)
+    return post(sql, user, key)
+
+
+def submitJob(sql, user=CARTO_USER, key=CARTO_KEY):
+    '''
+    Submit sql to the Batch SQL API and return the job id or False
+    The statement runs server side without holding a request open, so it
+    is not subject to the SQL API timeout; see waitJob.
+    '''
+    logging.debug('{} {}'.format(JOB_URL.format(user), sql[:200]))
+    body = json.dumps({'query': sql}).encode('utf-8')
+    t = time.time()
+    r = getSession().post(JOB_URL.format(user), params={'api_key': key},
+                          data=body,
+                          headers={'Content-Type': 'application/json'})
+    if _sinks:
+        _emit(sql, len(body), r, time.time() - t)
+    r = _checkResponse(r)
+    return r.json()['job_id'] if r else False
+
+
+def getJob(job_id, user=CARTO_USER, key=CARTO_KEY):
+    '''
+    Return the status of a Batch SQL API job as a dict
+    Requests are reported to sinks with verb JOB.
+    '''
+    t = time.time()
+    r = getSession().get('{}/{}'.format(JOB_URL.format(user), job_id),
+                         params={'api_key': key})
+    if _sinks:
+        _emit('JOB {}'.format(job_id), 0, r, time.time() - t)
+    r = _checkResponse(r)
+    return r.json() if r else False
+
+
+def waitJob(job_id, timeout=3600, interval=2, max_interval=60,
+            user=CARTO_USER, key=CARTO_KEY):
+    '''
+    Wait for a Batch SQL API job to finish and return its status dict
+    Polls every `interval` seconds, doubling up to `max_interval`, for at
+    most `timeout` seconds. Failed, canceled or timed out jobs are logged
+    and raise CartoError if STRICT, else return the last status.
+    '''
+    start = time.time()
+    while True:
+        job = getJob(job_id, user, key)
+        if not job:
+            return job
+        if job['status'] in JOB_FINISHED_STATES:
+            break
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            msg = 'Job {} still {} after {} seconds'.format(
+                job_id, job['status'], timeout)
+            logging.error(msg)
+            if STRICT:
+                raise CartoError(msg)
+            return job
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    if job['status'] != 'done':
+        msg = 'Job {} {}: {}'.format(job_id, job['status'],
+                                     job.get('failed_reason', ''))
+        logging.error(msg)
+        if STRICT:
+            raise CartoError(msg)
+    return job
+
+
+def insertNewRows(table, fields, dtypes, rows, id_field, user=CARTO_USER,
+                  key=CARTO_KEY, blocksize=1000, maxbytes=None, workers=1,
+                  precision=None):
+    '''
+    Insert only rows whose `id_field` is not already in table
+    Uses INSERT ... ON CONFLICT (`id_field`) DO NOTHING against its unique
+    index, so existing ids need not be downloaded to dedupe.
+    Other arguments as for insertRows.
+    '''
+    conflict = 'ON CONFLICT ({}) DO NOTHING'.format(id_field)
+    return _blockInsert(table, list(fields), tuple(dtypes), rows, user, key,
+                        blocksize, maxbytes, workers, conflict, precision)
+
+
+def filterNewIds(table, ids, id_field='uid', dtype='text', blocksize=1000,
+                 user=CARTO_USER, key=CARTO_KEY):
+    '''
+    Return the ids not yet present in table, deduplicated, in input order
+    Candidate ids are sent in blocks of `blocksize` as unnest(ARRAY[...])
+    and anti-joined against `id_field` server side; only the positions of
+    unseen ids are downloaded, so ids are returned exactly as given
+    whatever form `dtype` gives them in the table.
+    '''
+    unique = []
+    seen = set()
+    for i in ids:
+        if i not in seen:
+            seen.add(i)
+            unique.append(i)
+    new = []
+    for start in range(0, len(unique), blocksize):
+        values = ','.join([_escapeValue(i, dtype)
+                           for i in unique[start:start + blocksize]])
+        sql = ('SELECT c.n FROM unnest(ARRAY[{}]::{}[]) WITH ORDINALITY '
+               'AS c(id, n) WHERE NOT EXISTS '
+               '(SELECT 1 FROM "{}" t WHERE t.{} = c.id) ORDER BY c.n'
+               ).format(values, dtype, table, id_field)
+        r = post(sql, user, key)
+        if not r:
+            return False
+        new.extend(unique[start + row['n'] - 1] for row in r.json()['rows'])
+    return new
+
+
+def deleteExcessRows(table, max_rows, time_field, max_age='',
+                     user=CARTO_USER, key=CARTO_KEY, batch=False, wait=True):
+    '''
+    Delete rows older than `max_age` and all but the newest `max_rows`
+    Runs as a single server-side DELETE and returns the number of rows
+    dropped. Rows with a NULL `time_field` count as newest and are kept,
+    as when sorting ids client side.
+    `batch` run the DELETE as a Batch SQL API job instead, which is not
+    subject to the SQL API timeout; returns the job id (once the job is
+    done, if `wait`) since the job does not report a row count.
+    '''
+    if isinstance(max_age, datetime.datetime):
+        max_age = max_age.isoformat()
+    conditions = []
+    if max_age:
+        conditions.append("{} < '{}'".format(time_field, max_age))
+    if max_rows is not None:
+        conditions.append(
+            'cartodb_id IN (SELECT cartodb_id FROM "{}" '
+            'ORDER BY {} DESC OFFSET {})'.format(
+                table, time_field, int(max_rows)))
+    if not conditions:
+        return 0
+    if batch:
+        job_id = deleteRows(table, ' OR '.join(conditions), user, key,
+                            batch=True)
+        if job_id and wait:
+            waitJob(job_id, user=user, key=key)
+        return job_id
+    r = deleteRows(table, ' OR '.join(conditions), user, key)
+    num_dropped = r.json()['total_rows'] if r else 0
+    if num_dropped:
+        logging.info('Dropped {} old rows from {}'.format(num_dropped, table))
+    return num_dropped
 
 
 def deleteRowsByIDs(table, ids, id_field='cartodb_id', dtype='',
@@ -198,7 +1437,9 @@ def deleteRowsByIDs(table, ids, id_field='cartodb_id', dtype='',
 def dropTable(table, user=CARTO_USER, key=CARTO_KEY):
     '''Delete table'''
     sql = 'DROP TABLE "{}"'.format(table)
-    return post(sql)
+    r = post(sql, user, key)
+    invalidateCatalog(user)
+    return r
 
 def truncateTable(table, user=CARTO_USER, key=CARTO_KEY):
     '''Delete table'''
@@ -1,15 +1,51 @@
 import ee
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
 from google.cloud import storage 
 import os
 import rasterio
+import requests
+from collections import OrderedDict
+import heapq
 
 
 TASK_FINISHED_STATES = (ee.batch.Task.State.COMPLETED,
                         ee.batch.Task.State.FAILED,
                         ee.batch.Task.State.CANCELLED)
 
+# Number of sources uploaded to GCS at once (imageObject 'uploadWorkers')
+UPLOAD_WORKERS = 4
+# Bytes sent per resumable upload request; a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Consecutive failed chunk requests tolerated before an upload fails
+UPLOAD_RETRIES = 5
+# (connect, read) seconds before a stalled chunk request is retried
+UPLOAD_TIMEOUT = (10, 120)
+
+# Consecutive failed status checks tolerated by taskTracker.wait
+TASK_POLL_RETRIES = 5
+# Seconds a task may stay UNKNOWN before taskTracker fails it
+TASK_UNKNOWN_TIMEOUT = 300
+
+# Concurrent deletions and retries per asset in deleteAssets
+DELETE_WORKERS = 10
+DELETE_RETRIES = 4
+
+# Assets requested per page when listing collections (see iterAssets)
+LIST_PAGE_SIZE = 1000
+
+
+def writeKeyFile(path, content):
+    """Writes a key file, unless it already holds this content"""
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return
+    with open(path,'w') as f:
+        f.write(content)
+
 
 class getJsonEnv():
     """
@@ -17,14 +53,357 @@ class getJsonEnv():
     """
     def __init__(self):
         
-        with open('gcsPrivatekey.json','w') as f:
-            f.write(os.getenv('GCS_JSON'))
+        writeKeyFile('gcsPrivatekey.json', os.getenv('GCS_JSON'))
 
-        with open('geePrivatekey.json','w') as f:
-            f.write(os.getenv('GEE_JSON'))
+        writeKeyFile('geePrivatekey.json', os.getenv('GEE_JSON'))
 
-        
-    
+
+# Process-wide EE session and GCS client, set up once by initialize()
+_sessionLock = threading.RLock()
+_storageClient = None
+_buckets = {}
+
+
+def initialize():
+    """Writes the key files, initializes EE and creates the GCS client, once per process; returns the client"""
+    global _storageClient
+    with _sessionLock:
+        if _storageClient is None:
+            getJsonEnv()
+            credentials = ee.ServiceAccountCredentials(os.getenv('GEE_SACCOUNT'), 'geePrivatekey.json')
+            ee.Initialize(credentials)
+            _storageClient = storage.Client.from_service_account_json('gcsPrivatekey.json')
+        return _storageClient
+
+
+def getBucket(name):
+    """Returns the handle of a GCS bucket, looked up once per process"""
+    with _sessionLock:
+        if name not in _buckets:
+            _buckets[name] = initialize().get_bucket(name)
+        return _buckets[name]
+
+
+class taskTracker(object):
+    """
+    Tracks many GEE tasks, polling all of their statuses in a single
+    ee.data.getTaskStatus call every `interval` seconds.
+    add() returns a Future resolved with the task's final status (or a
+    ValueError if it did not complete); wait() blocks until every task has
+    finished, start() polls in a background thread instead. Failed status
+    checks are retried; if they keep failing, the background thread fails
+    the futures of all pending tasks with the error. Tasks still UNKNOWN
+    (as getTaskStatus reports ids it cannot look up) after `unknown_timeout`
+    seconds are failed.
+    Final statuses of finished tasks are kept in `statuses`, and their
+    queued and running durations in `durations`.
+    """
+    def __init__(self, interval=10, unknown_timeout=TASK_UNKNOWN_TIMEOUT):
+        self.interval = interval
+        self.unknown_timeout = unknown_timeout
+        self.unknownSince = {}
+        self.futures = {}
+        self.statuses = {}
+        self.durations = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, task_id, callback=None):
+        """Tracks a task, calling callback(future) when it finishes"""
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        with self.lock:
+            self.futures[task_id] = future
+        return future
+
+    def pending(self):
+        """Ids of tracked tasks that have not finished"""
+        with self.lock:
+            return [task_id for task_id, future in self.futures.items() if not future.done()]
+
+    def poll(self):
+        """Checks all pending tasks in one request and returns those still pending"""
+        pending = self.pending()
+        if not pending:
+            return []
+        running = []
+        now = time.time()
+        for status in ee.data.getTaskStatus(pending):
+            if status['state'] == 'UNKNOWN':
+                # reported briefly for just started ingestions, and for
+                # ids that cannot be looked up
+                since = self.unknownSince.setdefault(status['id'], now)
+                if now - since > self.unknown_timeout:
+                    self.finish(status)
+                    continue
+            else:
+                self.unknownSince.pop(status['id'], None)
+            if status['state'] in TASK_FINISHED_STATES:
+                self.finish(status)
+            else:
+                running.append(status)
+        return running
+
+    def finish(self, status):
+        """Records durations and resolves the future of a finished task"""
+        task_id = status['id']
+        self.statuses[task_id] = status
+        created = status.get('creation_timestamp_ms')
+        started = status.get('start_timestamp_ms')
+        updated = status.get('update_timestamp_ms')
+        self.durations[task_id] = {
+            'queued': (started - created) / 1000. if None not in (started, created) else None,
+            'running': (updated - started) / 1000. if None not in (updated, started) else None,
+        }
+        print('Task {0} ended at state: {1} (queued {queued}s, running {running}s)'.format(
+            task_id, status['state'], **self.durations[task_id]))
+        with self.lock:
+            future = self.futures[task_id]
+        if status['state'] == ee.batch.Task.State.COMPLETED:
+            future.set_result(status)
+        else:
+            future.set_exception(ValueError(status.get('error_message') or status['state']))
+
+    def fail(self, error):
+        """Fails the futures of all pending tasks with error"""
+        with self.lock:
+            futures = [future for future in self.futures.values() if not future.done()]
+        for future in futures:
+            future.set_exception(error)
+
+    def wait(self, timeout=None, log_progress=True):
+        """
+        Polls until all tracked tasks finish, or a timeout; returns True if they all finished.
+        Up to TASK_POLL_RETRIES consecutive failed status checks are retried.
+        """
+        start = time.time()
+        last_check = 0
+        failures = 0
+        while True:
+            try:
+                running = self.poll()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures > TASK_POLL_RETRIES:
+                    raise
+                print('Could not check task statuses, retrying: {0}'.format(e))
+                running = None
+            if running == []:
+                return True
+            elapsed = time.time() - start
+            if running and log_progress and elapsed - last_check >= 30:
+                for status in running:
+                    print('[{:%H:%M:%S}] Current state for task {}: {}'
+                          .format(datetime.now(), status['id'], status['state']))
+                last_check = elapsed
+            if timeout is not None:
+                remaining = timeout - elapsed
+                if remaining <= 0:
+                    print('Wait for tasks {0} timed out after {1:.2f} seconds'.format(
+                        self.pending(), elapsed))
+                    return False
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+
+    def run(self):
+        """Polls until all tracked tasks have finished, failing them all if status checks keep failing"""
+        try:
+            self.wait(log_progress=False)
+        except Exception as e:
+            print('Stopped tracking tasks {0}: {1}'.format(self.pending(), e))
+            self.fail(e)
+
+    def start(self):
+        """Polls in a background thread until all tracked tasks have finished"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+
+
+def isoTime(value):
+    """Formats a datetime as an RFC 3339 UTC timestamp; strings are returned as is"""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value
+
+
+def iterAssets(collection, start=None, end=None, pageSize=LIST_PAGE_SIZE):
+    """
+    Yields the assets of a collection one page of `pageSize` at a time from
+    ee.data.listAssets, as dicts with 'id', 'type' and, for images,
+    'startTime'. Assets are listed in the BASIC view, which leaves out
+    their properties and bands.
+    `start`/`end` (datetime or RFC 3339 string) keep only assets with
+    system:time_start in [start, end), filtered server side.
+    """
+    params = {'parent': collection, 'pageSize': pageSize, 'view': 'BASIC'}
+    filters = []
+    if start is not None:
+        filters.append('startTime >= "{0}"'.format(isoTime(start)))
+    if end is not None:
+        filters.append('startTime < "{0}"'.format(isoTime(end)))
+    if filters:
+        params['filter'] = ' AND '.join(filters)
+    while True:
+        response = ee.data.listAssets(params)
+        for asset in response.get('assets', []):
+            yield asset
+        token = response.get('nextPageToken')
+        if not token:
+            return
+        params['pageToken'] = token
+
+
+def listAssets(collection, start=None, end=None, pageSize=LIST_PAGE_SIZE):
+    """Lists the ids of assets in a collection, optionally with system:time_start in [start, end)"""
+    return [asset['id'] for asset in iterAssets(collection, start, end, pageSize)]
+
+
+def newestAssets(collection, n, start=None, end=None, pageSize=LIST_PAGE_SIZE):
+    """Ids of the `n` assets with the latest system:time_start, newest first, keeping only n in memory"""
+    newest = heapq.nlargest(n, iterAssets(collection, start, end, pageSize),
+                            key=lambda asset: asset.get('startTime', ''))
+    return [asset['id'] for asset in newest]
+
+
+def assetsBefore(collection, cutoff, pageSize=LIST_PAGE_SIZE):
+    """Ids of the assets with system:time_start before `cutoff`"""
+    return listAssets(collection, end=cutoff, pageSize=pageSize)
+
+
+def deleteAsset(assetId, retries=DELETE_RETRIES):
+    """
+    Deletes an asset, retrying transient errors with backoff; returns False if it did not exist.
+    EE reports missing assets and denied permission with the same error, so
+    an asset is only taken as already gone once getInfo no longer finds it.
+    """
+    attempt = 0
+    while True:
+        try:
+            ee.data.deleteAsset(assetId)
+            return True
+        except ee.EEException as e:
+            message = str(e).lower()
+            if 'not found' in message or 'does not exist' in message:
+                if ee.data.getInfo(assetId) is None:
+                    return False
+                raise
+            if 'permission' in message or attempt >= retries:
+                raise
+        except IOError:
+            if attempt >= retries:
+                raise
+        attempt += 1
+        time.sleep(2 ** attempt)
+
+
+def deleteAssets(assetIds, workers=DELETE_WORKERS, retries=DELETE_RETRIES, manifest=None):
+    """
+    Deletes assets concurrently through a pool of `workers` threads, retrying
+    transient errors, and returns the number of assets removed.
+    Failures are printed rather than raised so that one bad asset does not
+    stop the rest; removed or missing assets are discarded from `manifest` if given.
+    """
+    def delete(assetId):
+        try:
+            return deleteAsset(assetId, retries)
+        except Exception as e:
+            print('Could not delete {0}: {1}'.format(assetId, e))
+            return None
+    assetIds = list(assetIds)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        removed = list(pool.map(delete, assetIds))
+    if manifest is not None:
+        for assetId, result in zip(assetIds, removed):
+            if result is not None:
+                manifest.discard(os.path.basename(assetId))
+    count = sum(1 for result in removed if result)
+    print('Deleted {0} of {1} assets'.format(count, len(assetIds)))
+    return count
+
+
+def clearCollection(collection, workers=DELETE_WORKERS, manifest=None):
+    """Deletes every asset in a collection, keeping the collection; returns the number removed"""
+    return deleteAssets(listAssets(collection), workers, manifest=manifest)
+
+
+class collectionManifest(object):
+    """
+    Listing of a GEE image collection made once per run and kept up to date
+    in memory, so checking, listing and dating its assets does not cost an
+    EE metadata request each time.
+    Assets are keyed by name (the last part of the asset id, as returned by
+    eeUtil.ls); `getDate(name)` if given parses each asset's date.
+    Safe to update from other threads, e.g. taskTracker callbacks.
+    """
+    def __init__(self, collection, getDate=None, create=True):
+        self.collection = collection
+        self.getDate = getDate
+        self.create = create
+        self.assets = None
+        self.lock = threading.RLock()
+
+    def load(self, refresh=False):
+        """
+        Lists the collection, creating it if missing and `create`; returns {name: date}.
+        Hold `lock` while iterating the result if other threads may update the manifest.
+        """
+        with self.lock:
+            if self.assets is None or refresh:
+                self.assets = OrderedDict()
+                if ee.data.getInfo(self.collection) is None:
+                    if self.create:
+                        print('{} does not exist, creating'.format(self.collection))
+                        ee.data.createAsset({'type': 'ImageCollection'}, self.collection)
+                        ee.data.setAssetAcl(self.collection, '{"all_users_can_read" : true}')
+                else:
+                    for asset in iterAssets(self.collection):
+                        self.add(os.path.basename(asset['id']))
+            return self.assets
+
+    def path(self, name):
+        """Full asset id of an asset name"""
+        return '{0}/{1}'.format(self.collection, name)
+
+    def ls(self):
+        """Names of the assets in the collection"""
+        with self.lock:
+            return list(self.load())
+
+    def exists(self, name):
+        with self.lock:
+            return name in self.load()
+
+    def dates(self):
+        """Sorted dates of the assets in the collection"""
+        with self.lock:
+            return sorted(date for date in self.load().values() if date is not None)
+
+    def add(self, name):
+        """Records an asset added to the collection"""
+        date = self.getDate(name) if self.getDate else None
+        with self.lock:
+            assets = self.assets if self.assets is not None else self.load()
+            assets[name] = date
+
+    def discard(self, name):
+        """Records an asset removed from the collection"""
+        with self.lock:
+            self.load().pop(name, None)
+
+    def removeAsset(self, name):
+        """Deletes an asset from the collection and the manifest"""
+        deleteAsset(self.path(name))
+        self.discard(name)
+
+    def removeAssets(self, names, workers=DELETE_WORKERS):
+        """Deletes assets concurrently (see deleteAssets); returns the number removed"""
+        return deleteAssets([self.path(name) for name in names], workers, manifest=self)
 
 
 class assetManagement(object):
@@ -38,6 +417,7 @@ class assetManagement(object):
     'assetName':'t2000',
     'bandNames':[{'id': 'R'}, {'id': 'G'}, {'id': 'B'}],
     'pyramidingPolicy':'MODE',
+    'uploadWorkers':4, (optional, see UPLOAD_WORKERS)
     'properties':{
         'my_imageProperties':'to add to the collection'
         }   
@@ -45,7 +425,6 @@ class assetManagement(object):
     """
     def __init__(self,imageObject):
         """checks the image and sets up the properties """
-        getJsonEnv()
         self.meta=imageObject
         self.imageNames=self.getImageName()
         self.gcsBucket=self.setUpCredentials()
@@ -76,11 +455,8 @@ class assetManagement(object):
                     
     
     def setUpCredentials(self):
-        """Sets up the credentials"""
-        credentials = ee.ServiceAccountCredentials(os.getenv('GEE_SACCOUNT'), 'geePrivatekey.json')
-        ee.Initialize(credentials)
-        storage_client=storage.Client.from_service_account_json('gcsPrivatekey.json')
-        return storage_client.get_bucket(self.meta['gcsBucket'])
+        """Sets up the credentials, reusing the process-wide session (see initialize)"""
+        return getBucket(self.meta['gcsBucket'])
 
     def setUpGeeAsset(self):
         aclSet='{"all_users_can_read" : true}'
@@ -93,11 +469,59 @@ class assetManagement(object):
             ee.data.setAssetAcl(self.meta['collectionAsset'],aclSet)
        
     
+    def resumableUpload(self, blob, filename):
+        """Upload a file to blob in chunks through a resumable session; after a failed chunk, resumes from the last byte GCS committed"""
+        size = os.path.getsize(filename)
+        if not size:
+            blob.upload_from_filename(filename)
+            return
+        sessionUrl = blob.create_resumable_upload_session(size=size)
+        offset = 0
+        failures = 0
+        with open(filename, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                headers = {'Content-Range': 'bytes {0}-{1}/{2}'.format(offset, offset + len(chunk) - 1, size)}
+                try:
+                    r = requests.put(sessionUrl, data=chunk, headers=headers, timeout=UPLOAD_TIMEOUT)
+                    if r.status_code in (200, 201):
+                        return
+                    if r.status_code == 308:
+                        offset = self.committedBytes(r)
+                        failures = 0
+                        continue
+                    error = '{0}: {1}'.format(r.status_code, r.text)
+                except requests.exceptions.RequestException as e:
+                    error = str(e)
+                failures += 1
+                if failures > UPLOAD_RETRIES:
+                    raise IOError('Upload of {0} failed at byte {1}: {2}'.format(filename, offset, error))
+                print('Upload of {0} interrupted at byte {1}, resuming: {2}'.format(filename, offset, error))
+                time.sleep(2 ** failures)
+                # ask GCS how much of the file it has
+                try:
+                    r = requests.put(sessionUrl, headers={'Content-Range': 'bytes */{0}'.format(size)}, timeout=UPLOAD_TIMEOUT)
+                except requests.exceptions.RequestException:
+                    continue
+                if r.status_code in (200, 201):
+                    return
+                if r.status_code == 308:
+                    offset = self.committedBytes(r)
+
+    @staticmethod
+    def committedBytes(response):
+        """Bytes committed to a resumable upload, from the Range header of a 308 response"""
+        committed = response.headers.get('Range')
+        if not committed:
+            return 0
+        return int(committed.split('-')[-1]) + 1
+
     def uploadGCS(self, imageName):
         """Upload the image to google cloud storage"""
         imageIndex = self.imageNames.index(imageName)
         blob = self.gcsBucket.blob('{0}/{1}'.format(self.meta['collectionAsset'],imageName))
-        blob.upload_from_filename(self.meta['sources'][imageIndex])
+        self.resumableUpload(blob, self.meta['sources'][imageIndex])
         blob.make_public()
         
         return {'primaryPath': 'gs://{gcsBucket}/{collectionName}/{imageNa}'.format(gcsBucket=self.meta['gcsBucket'],collectionName=self.meta['collectionAsset'],imageNa=imageName)}
@@ -121,32 +545,19 @@ class assetManagement(object):
     
     def taskStatus(self, task_id, timeout=90, log_progress=True):
         """Waits for the specified task to finish, or a timeout to occur. (thanks to gee cli)"""
-        start = time.time()
-        elapsed = 0
-        last_check = 0
-        while True:
-            elapsed = time.time() - start
-            status = ee.data.getTaskStatus(task_id)[0]
-            state = status['state']
-            if state in TASK_FINISHED_STATES:
-              error_message = status.get('error_message', None)
-              print('Task %s ended at state: %s after %.2f seconds'
-                    % (task_id, state, elapsed))
-              if error_message:
+        tracker = taskTracker()
+        tracker.add(task_id)
+        if tracker.wait(timeout, log_progress):
+            error_message = tracker.statuses[task_id].get('error_message', None)
+            if error_message:
                 raise ValueError(error_message)
-              return
-            if log_progress and elapsed - last_check >= 30:
-              print('[{:%H:%M:%S}] Current state for task {}: {}'
-                    .format(datetime.now(), task_id, state))
-              last_check = elapsed
-            remaining = timeout - elapsed
-            if remaining > 0:
-              time.sleep(min(10, remaining))
-            else:
-              break
-        print('Wait for task %s timed out after %.2f seconds' % (task_id, elapsed))
+        return tracker.statuses.get(task_id)
 
-    def execute(self):
+    def execute(self, tracker=None, manifest=None):
+        """
+        Uploads and ingests the image; with a taskTracker, returns the ingestion's future instead of waiting for it.
+        A collectionManifest of the collection is updated once the ingestion completes.
+        """
         #Checks if the images are correct
         self.checksImages()
         
@@ -154,13 +565,24 @@ class assetManagement(object):
         
         self.setUpGeeAsset()
         
-        #Uploads file/s to GCS
-        self.sources = list(map(self.uploadGCS, self.imageNames))
+        #Uploads file/s to GCS in parallel
+        workers = self.meta.get('uploadWorkers', UPLOAD_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            self.sources = list(pool.map(self.uploadGCS, self.imageNames))
         
         #Transfers it from GCS to GEE
         task_id = self.transferGEE()
         
         print('TaskID: {0}'.format(task_id))
+        if tracker is not None:
+            if manifest is not None:
+                def addToManifest(future):
+                    if future.exception() is None:
+                        manifest.add(self.meta['assetName'])
+                return tracker.add(task_id, addToManifest)
+            return tracker.add(task_id)
         print('Status: {0}'.format(ee.data.getTaskStatus(task_id)[0]))
-        self.taskStatus(task_id)
+        status = self.taskStatus(task_id)
+        if manifest is not None and status and status['state'] == ee.batch.Task.State.COMPLETED:
+            manifest.add(self.meta['assetName'])
         
\ No newline at end of file
@@ -0,0 +1,118 @@
+'''
+Persistent local index of the UIDs in a CARTO table
+Keeps the UIDs already loaded into a table in a SQLite file under DATA_DIR
+so that each run only downloads rows added since the last one, instead of
+every existing UID.
+Example:
+```
+import uidIndex
+existing_ids = uidIndex.UidIndex(CARTO_TABLE, UID_FIELD)
+existing_ids.sync()
+if uid not in existing_ids:
+    ...
+```
+'''
+import os
+import sqlite3
+import logging
+from itertools import islice
+
+import cartoUploads
+
+DATA_DIR = 'data'
+# Number of rows written to the local index per transaction
+SYNC_BLOCKSIZE = 10000
+
+
+class UidIndex(object):
+    '''
+    Local index of `id_field` values in `table`, keyed by cartodb_id
+    sync() fetches rows with cartodb_id above the last one seen, drops
+    local rows below the table's lowest cartodb_id (rows removed by
+    retention), and falls back to a full resync if the table was cleared
+    or row counts still disagree.
+    '''
+    def __init__(self, table, id_field, data_dir=DATA_DIR,
+                 user=cartoUploads.CARTO_USER, key=cartoUploads.CARTO_KEY):
+        self.table = table
+        self.id_field = id_field
+        self.user = user
+        self.key = key
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.path = os.path.join(data_dir, '{}.uids.sqlite'.format(table))
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS uids '
+                          '(uid TEXT PRIMARY KEY, cartodb_id INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_uids_cartodb_id '
+                          'ON uids (cartodb_id)')
+        self.conn.commit()
+
+    def __contains__(self, uid):
+        return self.conn.execute('SELECT 1 FROM uids WHERE uid = ?',
+                                 (str(uid),)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM uids').fetchone()[0]
+
+    def __iter__(self):
+        for row in self.conn.execute('SELECT uid FROM uids ORDER BY cartodb_id'):
+            yield row[0]
+
+    def lastSeen(self):
+        '''Highest cartodb_id in the local index, or 0 if empty'''
+        return self.conn.execute(
+            'SELECT COALESCE(MAX(cartodb_id), 0) FROM uids').fetchone()[0]
+
+    def reset(self):
+        '''Empty the local index'''
+        self.conn.execute('DELETE FROM uids')
+        self.conn.commit()
+
+    def _remoteStats(self):
+        sql = ('SELECT COUNT(*) AS n, MIN(cartodb_id) AS lo, '
+               'MAX(cartodb_id) AS hi FROM "{}"'.format(self.table))
+        row = cartoUploads.get(sql, self.user, self.key).json()['rows'][0]
+        return row['n'], row['lo'], row['hi']
+
+    def _fetch(self, after):
+        '''Add remote rows with cartodb_id > `after`; return number added'''
+        rows = cartoUploads.iterFields(
+            [self.id_field, 'cartodb_id'], self.table,
+            where='cartodb_id > {}'.format(int(after)), dtypes=['', 'int'],
+            user=self.user, key=self.key)
+        added = 0
+        while True:
+            block = list(islice(rows, SYNC_BLOCKSIZE))
+            if not block:
+                break
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO uids (uid, cartodb_id) VALUES (?, ?)',
+                block)
+            self.conn.commit()
+            added += len(block)
+        return added
+
+    def sync(self):
+        '''Bring the local index up to date with the table; return its size'''
+        n, lo, hi = self._remoteStats()
+        last = self.lastSeen()
+        if not n or hi < last:
+            # table was cleared or truncated since the last sync
+            logging.info('Resetting local UID index for {}'.format(self.table))
+            self.reset()
+            last = 0
+        elif lo is not None:
+            self.conn.execute('DELETE FROM uids WHERE cartodb_id < ?', (lo,))
+            self.conn.commit()
+        added = self._fetch(last)
+        if len(self) != n:
+            logging.info('Local UID index for {} out of sync, reloading'.format(
+                self.table))
+            self.reset()
+            added = self._fetch(0)
+        logging.info('Synced {} new UIDs for {}'.format(added, self.table))
+        return len(self)
+
+    def close(self):
+        self.conn.close()